@@ -2,7 +2,6 @@
 
 '''Manage connections for ubxlib testing.'''
 
-from time import sleep
 import u_utils
 import u_settings
 
@@ -104,31 +103,24 @@ def get_instance(wanted_connection):
 def lock(connection, connection_lock, guard_time_seconds,
          printer, prompt):
     '''Lock the given connection'''
-    timeout_seconds = guard_time_seconds
     success = False
 
     if connection:
         instance_text = u_utils.get_instance_text(get_instance(connection))
         if connection_lock:
+            def report(timeout_seconds):
+                printer.string("{}instance {} still waiting {} second(s)"     \
+                               " for a connection lock (locker is"            \
+                               " currently {}).".                             \
+                               format(prompt, instance_text, timeout_seconds,
+                                      connection_lock))
             # Wait on the lock
             printer.string("{}instance {} waiting up to {} second(s)"   \
                            " to lock connection...".                    \
                            format(prompt, instance_text, guard_time_seconds))
-            count = 0
-            while not connection_lock.acquire(False) and                \
-                ((guard_time_seconds == 0) or (timeout_seconds > 0)):
-                sleep(1)
-                timeout_seconds -= 1
-                count += 1
-                if count == 30:
-                    printer.string("{}instance {} still waiting {} second(s)"     \
-                                   " for a connection lock (locker is"            \
-                                   " currently {}).".                             \
-                                   format(prompt, instance_text, timeout_seconds,
-                                          connection_lock))
-                    count = 0
-            if (guard_time_seconds == 0) or (timeout_seconds > 0):
-                success = True
+            success = u_utils.acquire_with_reports(connection_lock,
+                                                   guard_time_seconds, report)
+            if success:
                 printer.string("{}instance {} has locked a connection ({}).". \
                                format(prompt, instance_text, connection_lock))
         else:
@@ -82,20 +82,23 @@ class ReportThread(threading.Thread):
         threading.Thread.__init__(self)
     def _write_events(self, instance):
         '''Write the events for an instance to file'''
-        remove_list = []
+        strings = []
+        remaining_events = []
         for event in self._events:
             if event["instance"] == instance:
-                remove_list.append(event)
                 if self._file_handle:
-                    string = strftime(u_utils.TIME_FORMAT, event["timestamp"]) +  \
-                             " instance " + u_utils.get_instance_text(instance) + \
-                             " " + event_as_string(event) + ".\n"
-                    self._file_handle.write(string)
+                    strings.append(strftime(u_utils.TIME_FORMAT, event["timestamp"]) +  \
+                                   " instance " + u_utils.get_instance_text(instance) + \
+                                   " " + event_as_string(event) + ".\n")
+            else:
+                remaining_events.append(event)
         if self._file_handle:
+            # Write the lot in one go
+            self._file_handle.write("".join(strings))
             self._file_handle.flush()
-        # Remove the list items we've written
-        for item in remove_list:
-            self._events.remove(item)
+        # Keep only the list items we've not written, done
+        # in a single pass rather than a remove() per item
+        self._events = remaining_events
     def stop_thread(self):
         '''Helper function to stop the thread'''
         self._running = False
@@ -123,7 +126,7 @@ class ReportThread(threading.Thread):
         self._running = True
         while self._running:
             try:
-                event = self._queue.get(block=False, timeout=0.5)
+                event = self._queue.get(block=True, timeout=0.5)
                 self.add_event(event)
             except Empty:
                 pass
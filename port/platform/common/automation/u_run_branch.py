@@ -4,6 +4,7 @@
 
 import sys # for exit()
 import argparse
+import re
 from time import sleep
 import os # For sep and getcwd() and makedirs()
 from signal import signal, SIGINT, SIG_IGN         # for signal_handler
@@ -44,6 +45,25 @@ import u_settings
 # Prefix to put at the start of all prints
 PROMPT = "u_run_branch: "
 
+# Regex to find a test directive at the start of a line of
+# a Git note, capturing whatever follows the "test:";
+# compiled once here rather than on each line
+TEST_DIRECTIVE_REGEX = re.compile(r"test:(.*)", re.IGNORECASE | re.DOTALL)
+
+# Regex to check that an instance in a test directive is
+# well formed, i.e. x or x.y or x.y.z etc.
+INSTANCE_REGEX = re.compile(r"\d+(\.\d+)*", re.ASCII)
+
+# The characters an instance in a test directive may begin with:
+# only ASCII digits are valid so there is no need for the
+# Unicode tables behind str.isdigit()
+DIGITS = frozenset("0123456789")
+
+# What to print when a test directive is rejected,
+# assembled once here rather than each time
+BADLY_FORMED_DIRECTIVE_TEXT = PROMPT + "...badly formed test directive, ignoring."
+EXTRANEOUS_DIRECTIVE_TEXT = PROMPT + "...extraneous characters after test directive, ignoring."
+
 # Prefix for the individual instance working directory
 # Starts with a "u" in order that it gets sorted after
 # the name we usually use for the summary log
@@ -81,9 +101,75 @@ class NoDaemonPool(multiprocessing.pool.Pool):
         proc.__class__ = NoDaemonProcess
         return proc
 
+def parse_directive(text, instances):
+    '''Parse what follows "test:", filling instances and returning any filter string'''
+    instances_all = False
+    filter_string = None
+    reject_text = None
+
+    for part in text.split():
+        # Work out what sort of part this is just once
+        starts_with_digit = part[0] in DIGITS
+        is_star = part == "*"
+        if instances_all and (starts_with_digit or is_star):
+            # If we've had a "*" and this is another one
+            # or it begins with a digit then this is
+            # obviously not a "test:" line
+            reject_text = BADLY_FORMED_DIRECTIVE_TEXT
+            break
+        if filter_string:
+            # If we've had a filter string then nothing
+            # must follow so this is not a "test:" line
+            reject_text = EXTRANEOUS_DIRECTIVE_TEXT
+            break
+        if starts_with_digit:
+            # If this part begins with a digit it could
+            # be an instance containing numbers
+            if not INSTANCE_REGEX.fullmatch(part):
+                # Some rubbish, not a test line
+                reject_text = BADLY_FORMED_DIRECTIVE_TEXT
+                break
+            # Having been checked, the instance can be
+            # converted a "." at a time without needing
+            # to split it into a list first
+            instance = []
+            remainder = part
+            while remainder:
+                item, _, remainder = remainder.partition(".")
+                instance.append(int(item))
+            instances.append(instance)
+        elif is_star:
+            if instances:
+                # If we've already had any instances
+                # this is obviously not a test line
+                reject_text = BADLY_FORMED_DIRECTIVE_TEXT
+                break
+            # If we haven't had any instances and
+            # this is a * then it means "all"
+            instances.append(part)
+            instances_all = True
+        elif instances:
+            # If we've had an instance and this
+            # is not a "*" (dealt with above) then
+            # this must be a filter string
+            filter_string = part
+        else:
+            # Found some rubbish, not a "test:"
+            # line after all
+            reject_text = BADLY_FORMED_DIRECTIVE_TEXT
+            break
+
+    if reject_text:
+        # All rejections are tidied up here, emptying
+        # rather than replacing the list
+        del instances[:]
+        filter_string = None
+        print(reject_text)
+
+    return filter_string
+
 def parse_message(message, instances):
     '''Find stuff in a Git note'''
-    instances_all = False
     instances_local = []
     filter_string_local = None
 
@@ -95,109 +181,39 @@ def parse_message(message, instances):
         lines = message.split("\\n")
         for idx1, line in enumerate(lines):
             print("{}text line {}: \"{}\"".format(PROMPT, idx1 + 1, line))
-            if line.lower().startswith("test:"):
-                instances_all = False
-                # Pick through what follows
-                parts = line[5:].split()
-                for part in parts:
-                    if instances_all and (part[0].isdigit() or part == "*"):
-                        # If we've had a "*" and this is another one
-                        # or it begins with a digit then this is
-                        # obviously not a "test:" line,
-                        # leave the loop and try again.
-                        instances_local = []
-                        filter_string_local = None
-                        print("{}...badly formed test directive, ignoring.".format(PROMPT))
-                        break
-                    if filter_string_local:
-                        # If we've had a filter string then nothing
-                        # must follow so this is not a "test:" line,
-                        # leave the loop and try again.
-                        instances_local = []
-                        filter_string_local = None
-                        print("{}...extraneous characters after test directive, ignoring.". \
-                              format(PROMPT))
-                        break
-                    if part[0].isdigit():
-                        # If this part begins with a digit it could
-                        # be an instance containing numbers
-                        instance = []
-                        bad = False
-                        for item in part.split("."):
-                            try:
-                                instance.append(int(item))
-                            except ValueError:
-                                # Some rubbish, not a test line so
-                                # leave the loop and try the next
-                                # line
-                                bad = True
-                                break
-                        if bad:
-                            instances_local = []
-                            filter_string_local = None
-                            print("{}...badly formed test directive, ignoring.".format(PROMPT))
-                            break
-                        if instance:
-                            instances_local.append(instance[:])
-                    elif part == "*":
-                        if instances_local:
-                            # If we've already had any instances
-                            # this is obviously not a test line,
-                            # leave the loop and try again
-                            instances_local = []
-                            filter_string_local = None
-                            print("{}...badly formed test directive, ignoring.".format(PROMPT))
-                            break
-                        # If we haven't had any instances and
-                        # this is a * then it means "all"
-                        instances_local.append(part)
-                        instances_all = True
-                    elif instances_local and not part == "*":
-                        # If we've had an instance and this
-                        # is not a "*" then this must be a
-                        # filter string
-                        filter_string_local = part
-                    else:
-                        # Found some rubbish, not a "test:"
-                        # line after all, leave the loop
-                        # and try the next line
-                        instances_local = []
-                        filter_string_local = None
-                        print("{}...badly formed test directive, ignoring.".format(PROMPT))
-                        break
-                if instances_local:
-                    found = "found test directive with instance(s) "
-                    for idx2, entry in enumerate(instances_local):
-                        if idx2 > 0:
-                            found += ", "
-                        for idx3, item in enumerate(entry):
-                            if idx3 == 0:
-                                found += str(item)
-                            else:
-                                found += "." + str(item)
-                    if filter_string_local:
-                        found += " and filter \"" + filter_string_local + "\""
-                    print("{}{}.".format(PROMPT, found))
-                    break
+            match = TEST_DIRECTIVE_REGEX.match(line)
+            if not match:
+                continue
+            filter_string_local = parse_directive(match.group(1), instances_local)
+            if not instances_local:
+                # Not a test directive after all, on to the next line
                 print("{}no test directive found".format(PROMPT))
+                continue
+            found = "found test directive with instance(s) "
+            for idx2, entry in enumerate(instances_local):
+                if idx2 > 0:
+                    found += ", "
+                for idx3, item in enumerate(entry):
+                    if idx3 == 0:
+                        found += str(item)
+                    else:
+                        found += "." + str(item)
+            if filter_string_local:
+                found += " and filter \"" + filter_string_local + "\""
+            print("{}{}.".format(PROMPT, found))
+            break
 
     if instances_local:
-        instances.extend(instances_local[:])
+        instances.extend(instances_local)
 
     return filter_string_local
 
 def create_platform_locks(database, instances, manager, platform_locks):
-    '''Create a lock per platform in platform_locks'''
+    '''Create a lock per platform in platform_locks, keyed by platform'''
     for instance in instances:
         this_platform = u_data.get_platform_for_instance(database, instance)
-        if this_platform:
-            done = False
-            for platform in platform_locks:
-                if this_platform == platform["platform"]:
-                    done = True
-                    break
-            if not done:
-                platform_locks.append({"platform": this_platform, "lock": manager.RLock()})
+        if this_platform and this_platform not in platform_locks:
+            platform_locks[this_platform] = manager.RLock()
 
 def run_instances(database, instances, filter_string, ubxlib_dir,
                   working_dir, clean, summary_report_file,
@@ -205,7 +221,7 @@ def run_instances(database, instances, filter_string, ubxlib_dir,
     '''Run the given instances'''
     return_value = 0
     processes = []
-    platform_locks = []
+    platform_locks = {}
     misc_locks = {}
     alive_count = 0
     report_thread = None
@@ -240,6 +256,10 @@ def run_instances(database, instances, filter_string, ubxlib_dir,
     # whole time as we have to do with Nordic, because
     # each STM32F4 board only runs a single instance
     misc_locks["stm32f4_downloads_list"] = manager.list()
+    # ...and a condition, held while an entry is removed
+    # from that list and notified afterwards, so that those
+    # waiting on it don't have to poll
+    misc_locks["stm32f4_downloads_condition"] = manager.Condition()
 
     # It is possible for some platforms to be a bit
     # pants at running in multiple instances
@@ -320,12 +340,8 @@ def run_instances(database, instances, filter_string, ubxlib_dir,
             process = {}
             process["platform"] = u_data.get_platform_for_instance(database, instance)
             process["instance"] = instance
-            process["platform_lock"] = None
+            process["platform_lock"] = platform_locks.get(process["platform"])
             process["connection_lock"] = u_connection.get_lock(instance)
-            for platform_lock in platform_locks:
-                if process["platform"] == platform_lock["platform"]:
-                    process["platform_lock"] = platform_lock["lock"]
-                    break
             process["handle"] = pool.apply_async(u_run.main,
                                                  (database, instance,
                                                   filter_string, True,
@@ -430,6 +430,17 @@ def open_ocd(commands, connection):
 
     return call_list
 
+def download_list_remove(download_list, instance_text, download_condition):
+    '''Remove us from the list of pending downloads'''
+    if download_condition:
+        # Remove while holding the condition so that a waiter
+        # can't miss it, then tell the waiters
+        with download_condition:
+            download_list.remove(instance_text)
+            download_condition.notify_all()
+    else:
+        download_list.remove(instance_text)
+
 def swo_decode_process(swo_data_file, swo_decoded_text_file):
     '''Grab SWO data from a file, decode it and write it to another file'''
     file_handle_in = open(swo_data_file, "rb")
@@ -469,6 +480,7 @@ def run(instance, mcu, toolchain, connection, connection_lock,
     elf_path = None
     downloaded = False
     download_list = None
+    download_condition = None
 
     # Only one toolchain for STM32Cube
     del toolchain
@@ -503,6 +515,8 @@ def run(instance, mcu, toolchain, connection, connection_lock,
     if misc_locks and ("stm32f4_downloads_list" in misc_locks):
         download_list = misc_locks["stm32f4_downloads_list"]
         download_list.append(instance_text)
+        if "stm32f4_downloads_condition" in misc_locks:
+            download_condition = misc_locks["stm32f4_downloads_condition"]
 
     reporter.event(u_report.EVENT_TYPE_BUILD,
                    u_report.EVENT_START,
@@ -602,13 +616,16 @@ def run(instance, mcu, toolchain, connection, connection_lock,
                                                        u_report.EVENT_COMPLETE)
                                         # Remove us from the list of pending downloads
                                         if download_list:
-                                            download_list.remove(instance_text)
+                                            download_list_remove(download_list,
+                                                                 instance_text,
+                                                                 download_condition)
                                             # Wait for all the other downloads to complete before
                                             # starting SWO logging
                                             u_utils.wait_for_completion(download_list,
                                                                         "STM32F4 downloads",
                                                                         DOWNLOADS_COMPLETE_GUARD_TIME_SECONDS,
-                                                                        printer, prompt)
+                                                                        printer, prompt,
+                                                                        download_condition)
                                         # So that all STM32Cube instances don't start up at
                                         # once, which can also cause problems, wait the
                                         # instance-number number of seconds.
@@ -699,7 +716,8 @@ def run(instance, mcu, toolchain, connection, connection_lock,
 
     # Remove us from the list of pending downloads for safety
     try:
-        misc_locks["stm32f4_downloads_list"].remove(instance_text)
+        download_list_remove(misc_locks["stm32f4_downloads_list"],
+                             instance_text, download_condition)
     except (AttributeError, ValueError, TypeError):
         pass
 
@@ -260,6 +260,7 @@ def select(database, instances, paths):
     interesting = []
     instances_local = []
     dedup = []
+    seen = set()
     filter_string = None
 
     print("{}selecting what instances to run based on {} file(s)...".
@@ -299,9 +300,12 @@ def select(database, instances, paths):
     print("{}adding instances that are always run...".format(PROMPT))
     instances_local.extend(INSTANCES_ALWAYS[:])
 
-    # Create a de-duplicated list
+    # Create a de-duplicated list, using a set of
+    # tuples to check membership rather than
+    # searching the list each time
     for instance in instances_local:
-        if instance not in dedup:
+        if tuple(instance) not in seen:
+            seen.add(tuple(instance))
             dedup.append(instance[:])
 
     # Append to the list that was passed in
@@ -4,7 +4,7 @@
 
 import queue                    # For PrintThread and exe_run
 from time import sleep, time, gmtime, strftime   # For lock timeout, exe_run timeout and logging
-import threading                # For PrintThread
+import threading                # For PrintThread and PrintToQueue
 import os                       # For ChangeDir, has_admin
 import stat                     # To help deltree out
 from telnetlib import Telnet # For talking to JLink server
@@ -13,9 +13,13 @@ import shutil                   # To delete a directory tree
 import signal                   # For CTRL_C_EVENT
 import subprocess
 import platform                 # Figure out current OS
+import ctypes                   # For has_admin
+import re                       # For usb_reset
 import serial                   # Pyserial (make sure to do pip install pyserial)
 import psutil                   # For killing things (make sure to do pip install psutil)
 import u_settings
+if platform.system() == "Linux":
+    import fcntl                # For exe_run pipe size, Linux only
 
 # How long to wait for an install lock in seconds
 INSTALL_LOCK_WAIT_SECONDS = u_settings.INSTALL_LOCK_WAIT_SECONDS #(60 * 60)
@@ -72,45 +76,95 @@ FILTER_MACRO_NAME = u_settings.FILTER_MACRO_NAME #"U_CFG_APP_FILTER"
 # and moved on
 EXE_RUN_QUEUE_WAIT_SECONDS = u_settings.EXE_RUN_QUEUE_WAIT_SECONDS #1
 
+# The interval at which to print a "still waiting" message
+# while waiting for a lock, in seconds
+STILL_WAITING_REPORT_SECONDS = 30
+
+# How long exe_terminate() gives a process tree to go
+# before killing it, in seconds
+EXE_TERMINATE_WAIT_SECONDS = 5
+
+# True if we're running on Linux: worked out once
+# here since it can't change while we're running
+IS_LINUX = platform.system() == "Linux"
+
+# True if we're running on Windows, similarly worked out once
+IS_WINDOWS = os.name == "nt"
+
+# The Windows temporary directory, which only users with
+# administrator privileges can read; see has_admin()
+WINDOWS_TEMP_DIR = os.sep.join([os.environ.get("SystemRoot", "C:\\windows"), "temp"])
+
+# The marker echoed by exe_run() between the output of the
+# executable and the output of "set" when returning the
+# environment
+FLIBBLE = "flibble"
+
+# How long the subst drive mappings read by get_actual_path()
+# are kept for before being read again, in seconds
+SUBST_CACHE_SECONDS = 300
+
+# The longest a line written by PrintToQueue stays in
+# its file's buffer before being flushed, in seconds
+PRINT_FILE_FLUSH_SECONDS = 1
+
+# The size to make the pipe carrying the output of
+# exe_run() on Linux, so that a chatty executable
+# isn't held up waiting for us to read it
+EXE_RUN_PIPE_SIZE = 1 << 20
+
+# The cached subst drive mappings and when they were read
+SUBST_CACHE = {"time": 0, "map": None}
+
+# The executables that exe_where() has found, and
+# where, so that they need only be looked for once
+EXE_WHERE_CACHE = {}
+
 def subprocess_osify(cmd):
     ''' expects an array of strings being [command, param, ...] '''
-    if platform.system() == "Linux":
+    if IS_LINUX:
         return [ ' '.join(cmd) ]
     return cmd
 
+def get_subst_map():
+    '''Return a dictionary of subst drive to real path, cached'''
+    if SUBST_CACHE["map"] is None or \
+       time() - SUBST_CACHE["time"] > SUBST_CACHE_SECONDS:
+        subst_map = {}
+        # Get a list of substs
+        text = subprocess.check_output("subst",
+                                       stderr=subprocess.STDOUT,
+                                       shell=True)  # Jenkins hangs without this
+        for line in text.splitlines():
+            # Lines should look like this:
+            # Z:\: => C:\projects\ubxlib_priv
+            # ...which goes into the dictionary as
+            # "z:" => "C:\projects\ubxlib_priv"
+            bits = line.decode().rsplit(": => ")
+            if len(bits) > 1:
+                subst_map[bits[0].lower()[0:2]] = bits[1]
+        SUBST_CACHE["map"] = subst_map
+        SUBST_CACHE["time"] = time()
+
+    return SUBST_CACHE["map"]
+
 def get_actual_path(path):
     '''Given a drive number return real path if it is a subst'''
     actual_path = path
 
-    # Get a list of substs
-    text = subprocess.check_output("subst",
-                                   stderr=subprocess.STDOUT,
-                                   shell=True)  # Jenkins hangs without this
-    for line in text.splitlines():
-        # Lines should look like this:
-        # Z:\: => C:\projects\ubxlib_priv
-        # So, in this example, if we were given z:\blah
-        # then the actual path should be C:\projects\ubxlib_priv\blah
-        text = line.decode()
-        bits =  text.rsplit(": => ")
-        if (len(bits) > 1) and (len(path) > 1) and \
-          (bits[0].lower()[0:2] == path[0:2].lower()):
-            actual_path = bits[1] + path[2:]
-            break
+    # So, if we were given z:\blah and z: is a subst
+    # for C:\projects\ubxlib_priv then the actual path
+    # should be C:\projects\ubxlib_priv\blah
+    if len(path) > 1:
+        real_path = get_subst_map().get(path[0:2].lower())
+        if real_path is not None:
+            actual_path = real_path + path[2:]
 
     return actual_path
 
 def get_instance_text(instance):
     '''Return the instance as a text string'''
-    instance_text = ""
-
-    for idx, item in enumerate(instance):
-        if idx == 0:
-            instance_text += str(item)
-        else:
-            instance_text += "." + str(item)
-
-    return instance_text
+    return ".".join(map(str, instance))
 
 def remove_readonly(func, path, exec_info):
     '''Help deltree out'''
@@ -151,13 +205,19 @@ def has_admin():
     '''Check for administrator privileges'''
     admin = False
 
-    if os.name == 'nt':
+    if IS_WINDOWS:
         try:
-            # only Windows users with admin privileges can read the C:\windows\temp
-            if os.listdir(os.sep.join([os.environ.get("SystemRoot", "C:\\windows"), "temp"])):
-                admin = True
-        except PermissionError:
-            pass
+            # Ask Windows directly: this is just a check of the
+            # process token.  Pylint will complain about windll
+            # but it is only accessed on Windows, where it exists
+            admin = bool(ctypes.windll.shell32.IsUserAnAdmin())
+        except (OSError, AttributeError):
+            try:
+                # only Windows users with admin privileges can read the C:\windows\temp
+                if os.listdir(WINDOWS_TEMP_DIR):
+                    admin = True
+            except PermissionError:
+                pass
     else:
         # Pylint will complain about the following line but
         # that's OK, it is only executed if we're NOT on Windows
@@ -182,32 +242,30 @@ def usb_reset(device_description, printer, prompt):
         text = subprocess.check_output(subprocess_osify(cmd),
                                        stderr=subprocess.STDOUT,
                                        shell=True) # Jenkins hangs without this
-        for line in text.splitlines():
-            # The format of a devcon entry is this:
-            #
-            # USB\VID_1366&PID_1015&MI_00\6&38E81674&0&0000
-            #     Name: JLink CDC UART Port (COM45)
-            #     Hardware IDs:
-            #         USB\VID_1366&PID_1015&REV_0100&MI_00
-            #         USB\VID_1366&PID_1015&MI_00
-            #     Compatible IDs:
-            #         USB\Class_02&SubClass_02&Prot_00
-            #         USB\Class_02&SubClass_02
-            #         USB\Class_02
-            #
-            # Grab what we hope is the instance ID
-            line = line.decode()
-            if line.startswith("USB"):
-                instance_id = line
-            else:
-                # If the next line is the Name we want then we're done
-                if instance_id and ("Name: " + device_description in line):
-                    found = True
-                    printer.string("{}\"{}\" found with instance ID \"{}\"".    \
-                                   format(prompt, device_description,
-                                          instance_id))
-                    break
-                instance_id = None
+        # The format of a devcon entry is this:
+        #
+        # USB\VID_1366&PID_1015&MI_00\6&38E81674&0&0000
+        #     Name: JLink CDC UART Port (COM45)
+        #     Hardware IDs:
+        #         USB\VID_1366&PID_1015&REV_0100&MI_00
+        #         USB\VID_1366&PID_1015&MI_00
+        #     Compatible IDs:
+        #         USB\Class_02&SubClass_02&Prot_00
+        #         USB\Class_02&SubClass_02
+        #         USB\Class_02
+        #
+        # Look for a line beginning with USB, which is what
+        # we hope is the instance ID, followed immediately by
+        # a line with the Name we want
+        match = re.search(rb"^(USB[^\r\n]*)\r?\n[^\r\n]*Name: " +
+                          re.escape(device_description.encode()),
+                          text, re.MULTILINE)
+        if match:
+            instance_id = match.group(1).decode()
+            found = True
+            printer.string("{}\"{}\" found with instance ID \"{}\"".    \
+                           format(prompt, device_description,
+                                  instance_id))
         if found:
             # Now run devcon to reset the device
             printer.string("{}running {} to reset device \"{}\"...".   \
@@ -260,18 +318,41 @@ def open_telnet(port_number, printer, prompt):
                               port_number, str(ex)))
     return telnet_handle
 
+def acquire_with_reports(lock, guard_time_seconds, report_function):
+    '''Acquire a lock, reporting that we're still waiting'''
+    # guard_time_seconds of 0 means wait forever; every
+    # STILL_WAITING_REPORT_SECONDS report_function() is
+    # called with the number of seconds left to wait
+    acquired = False
+    timeout_seconds = guard_time_seconds
+    start_time = time()
+    while not acquired and                                      \
+        ((guard_time_seconds == 0) or (timeout_seconds > 0)):
+        # Block on the lock, rather than polling it, but
+        # wake up periodically to say that we're still waiting
+        wait_seconds = STILL_WAITING_REPORT_SECONDS
+        if (guard_time_seconds > 0) and (timeout_seconds < wait_seconds):
+            wait_seconds = timeout_seconds
+        if lock.acquire(timeout=wait_seconds):
+            acquired = True
+        else:
+            timeout_seconds = guard_time_seconds - int(time() - start_time)
+            if (guard_time_seconds == 0) or (timeout_seconds > 0):
+                report_function(timeout_seconds)
+
+    return acquired
+
 def install_lock_acquire(install_lock, printer, prompt):
     '''Attempt to acquire install lock'''
-    timeout_seconds = INSTALL_LOCK_WAIT_SECONDS
     success = False
 
+    def report(timeout_seconds):
+        printer.string("{}still waiting {} second(s) for install lock.". \
+                       format(prompt, timeout_seconds))
+
     if install_lock:
         printer.string("{}waiting for install lock...".format(prompt))
-        while not install_lock.acquire(False) and (timeout_seconds > 0):
-            sleep(1)
-            timeout_seconds -= 1
-
-        if timeout_seconds > 0:
+        if acquire_with_reports(install_lock, INSTALL_LOCK_WAIT_SECONDS, report):
             printer.string("{}got install lock.".format(prompt))
             success = True
         else:
@@ -300,22 +381,23 @@ def fetch_repo(url, directory, branch, printer, prompt):
     if not branch:
         branch = "master"
     if os.path.isdir(directory):
-        # Update existing code
-        with ChangeDir(directory):
-            printer.string("{}updating code in {}...".
-                           format(prompt, directory))
-            try:
-                text = subprocess.check_output(subprocess_osify(["git", "pull",
-                                                "origin", branch]),
-                                               stderr=subprocess.STDOUT,
-                                               shell=True) # Jenkins hangs without this
-                for line in text.splitlines():
-                    printer.string("{}{}".format(prompt, line.decode()))
-                got_code = True
-            except subprocess.CalledProcessError as error:
-                printer.string("{}git returned error {}: \"{}\"".
-                               format(prompt, error.returncode,
-                                      error.output))
+        # Update existing code; git is pointed at the
+        # directory with -C here and below, no need to
+        # change to it
+        printer.string("{}updating code in {}...".
+                       format(prompt, directory))
+        try:
+            text = subprocess.check_output(subprocess_osify(["git", "-C", directory,
+                                            "pull", "origin", branch]),
+                                           stderr=subprocess.STDOUT,
+                                           shell=True) # Jenkins hangs without this
+            for line in text.splitlines():
+                printer.string("{}{}".format(prompt, line.decode()))
+            got_code = True
+        except subprocess.CalledProcessError as error:
+            printer.string("{}git returned error {}: \"{}\"".
+                           format(prompt, error.returncode,
+                                  error.output))
     else:
         # Clone the repo
         printer.string("{}cloning from {} into {}...".
@@ -334,75 +416,82 @@ def fetch_repo(url, directory, branch, printer, prompt):
 
     if got_code and os.path.isdir(directory):
         # Check out the correct branch and recurse submodules
-        with ChangeDir(directory):
-            printer.string("{}checking out branch {}...".
-                           format(prompt, branch))
+        printer.string("{}checking out branch {}...".
+                       format(prompt, branch))
+        try:
+            text = subprocess.check_output(subprocess_osify(["git", "-C", directory,
+                                            "-c", "advice.detachedHead=false",
+                                            "checkout",
+                                            "origin/" + branch]),
+                                           stderr=subprocess.STDOUT,
+                                           shell=True) # Jenkins hangs without this
+            for line in text.splitlines():
+                printer.string("{}{}".format(prompt, line.decode()))
+            checked_out = True
+        except subprocess.CalledProcessError as error:
+            printer.string("{}git returned error {}: \"{}\"".
+                           format(prompt, error.returncode,
+                                  error.output))
+
+        if checked_out:
+            printer.string("{}recursing sub-modules (can take some time" \
+                           " and gives no feedback).".format(prompt))
             try:
-                text = subprocess.check_output(subprocess_osify(["git", "-c",
-                                                "advice.detachedHead=false",
-                                                "checkout",
-                                                "origin/" + branch]),
+                text = subprocess.check_output(subprocess_osify(["git", "-C", directory,
+                                                "submodule", "update", "--init",
+                                                "--recursive"]),
                                                stderr=subprocess.STDOUT,
                                                shell=True) # Jenkins hangs without this
                 for line in text.splitlines():
                     printer.string("{}{}".format(prompt, line.decode()))
-                checked_out = True
+                success = True
             except subprocess.CalledProcessError as error:
                 printer.string("{}git returned error {}: \"{}\"".
                                format(prompt, error.returncode,
                                       error.output))
 
-            if checked_out:
-                printer.string("{}recursing sub-modules (can take some time" \
-                               " and gives no feedback).".format(prompt))
-                try:
-                    text = subprocess.check_output(subprocess_osify(["git", "submodule",
-                                                    "update", "--init",
-                                                    "--recursive"]),
-                                                   stderr=subprocess.STDOUT,
-                                                   shell=True) # Jenkins hangs without this
-                    for line in text.splitlines():
-                        printer.string("{}{}".format(prompt, line.decode()))
-                    success = True
-                except subprocess.CalledProcessError as error:
-                    printer.string("{}git returned error {}: \"{}\"".
-                                   format(prompt, error.returncode,
-                                          error.output))
-
     return success
 
 def exe_where(exe_name, help_text, printer, prompt):
     '''Find an executable using where.exe or which on linux'''
     success = False
 
-    try:
-        printer.string("{}looking for \"{}\"...".          \
-                       format(prompt, exe_name))
-        # See here:
-        # https://stackoverflow.com/questions/14928860/passing-double-quote-shell-commands-in-python-to-subprocess-popen
-        # ...for why the construction "".join() is necessary when
-        # passing things which might have spaces in them.
-        # It is the only thing that works.
-        if platform.system() == "Linux":
-            cmd = ["which {}".format(exe_name)]
-            printer.string("{}detected linux, calling \"{}\"...".format(prompt, cmd))
-        else:
-            cmd = ["where", "".join(exe_name)]
-            printer.string("{}detected nonlinux, calling \"{}\"...".format(prompt, cmd))
-        text = subprocess.check_output(cmd,
-                                       stderr=subprocess.STDOUT,
-                                       shell=True) # Jenkins hangs without this
-        for line in text.splitlines():
-            printer.string("{}{} found in {}".format(prompt, exe_name,
-                                                     line.decode()))
+    # Tools don't move while we're running so, if we've
+    # found this one before, say where it was again
+    paths = EXE_WHERE_CACHE.get(exe_name)
+    if paths is not None:
+        for path in paths:
+            printer.string("{}{} found in {}".format(prompt, exe_name, path))
         success = True
-    except subprocess.CalledProcessError:
-        if help_text:
-            printer.string("{}ERROR {} not found: {}".  \
-                           format(prompt, exe_name, help_text))
-        else:
-            printer.string("{}ERROR {} not found".      \
+    else:
+        try:
+            printer.string("{}looking for \"{}\"...".          \
                            format(prompt, exe_name))
+            # Note: on Windows, things which might have spaces
+            # in them must be separate items in the list so that
+            # subprocess quotes them, see here:
+            # https://stackoverflow.com/questions/14928860/passing-double-quote-shell-commands-in-python-to-subprocess-popen
+            if IS_LINUX:
+                cmd = ["which {}".format(exe_name)]
+                printer.string("{}detected linux, calling \"{}\"...".format(prompt, cmd))
+            else:
+                cmd = ["where", exe_name]
+                printer.string("{}detected nonlinux, calling \"{}\"...".format(prompt, cmd))
+            text = subprocess.check_output(cmd,
+                                           stderr=subprocess.STDOUT,
+                                           shell=True) # Jenkins hangs without this
+            paths = [line.decode() for line in text.splitlines()]
+            for path in paths:
+                printer.string("{}{} found in {}".format(prompt, exe_name, path))
+            EXE_WHERE_CACHE[exe_name] = paths
+            success = True
+        except subprocess.CalledProcessError:
+            if help_text:
+                printer.string("{}ERROR {} not found: {}".  \
+                               format(prompt, exe_name, help_text))
+            else:
+                printer.string("{}ERROR {} not found".      \
+                               format(prompt, exe_name))
 
     return success
 
@@ -413,7 +502,7 @@ def exe_version(exe_name, version_switch, printer, prompt):
     if not version_switch:
         version_switch = "--version"
     try:
-        text = subprocess.check_output(subprocess_osify(["".join(exe_name), version_switch]),
+        text = subprocess.check_output(subprocess_osify([exe_name, version_switch]),
                                        stderr=subprocess.STDOUT,
                                        shell=True)  # Jenkins hangs without this
         for line in text.splitlines():
@@ -425,39 +514,65 @@ def exe_version(exe_name, version_switch, printer, prompt):
 
     return success
 
-def exe_terminate(process_pid):
+def exe_terminate(exe_process):
     '''Jonathan's killer'''
-    process = psutil.Process(process_pid)
-    for proc in process.children(recursive=True):
-        proc.terminate()
-    process.terminate()
+    process_pid = exe_process.pid
+    if IS_LINUX:
+        # exe_run() starts the process in a new session, so
+        # its process group ID is its PID and the whole tree
+        # can be terminated in one go; give the process time
+        # to go and then kill whatever is left of the group
+        # (its exited children can stay in the group as
+        # zombies, so waiting for the group itself to empty
+        # would wait for init)
+        try:
+            os.killpg(process_pid, signal.SIGTERM)
+            try:
+                exe_process.wait(timeout=EXE_TERMINATE_WAIT_SECONDS)
+            except subprocess.TimeoutExpired:
+                pass
+            os.killpg(process_pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    else:
+        try:
+            process = psutil.Process(process_pid)
+            processes = process.children(recursive=True)
+        except psutil.NoSuchProcess:
+            # exe_run() keeps reading while anything still
+            # holds stdout open, so the process itself may
+            # already have gone
+            return
+        processes.append(process)
+        # Terminate the lot and then wait for them all
+        # together, killing any that won't go
+        for proc in processes:
+            try:
+                proc.terminate()
+            except psutil.NoSuchProcess:
+                pass
+        _, alive = psutil.wait_procs(processes,
+                                     timeout=EXE_TERMINATE_WAIT_SECONDS)
+        for proc in alive:
+            try:
+                proc.kill()
+            except psutil.NoSuchProcess:
+                pass
 
 def read_from_process_and_queue(process, read_queue):
-    '''Read from a process, non-blocking'''
-    while process.poll() is None:
-        string = process.stdout.readline().decode()
-        if string:
-            read_queue.put(string)
-
-def queue_get_no_exception(the_queue, block=True, timeout=None):
-    '''A version of queue.get() that doesn't throw an Empty exception'''
-    thing = None
-
-    try:
-        thing = the_queue.get(block=block, timeout=timeout)
-    except queue.Empty:
-        pass
-
-    return thing
+    '''Read lines from a process onto a queue, None marks EOF'''
+    for string in iter(process.stdout.readline, b""):
+        read_queue.put(string.decode())
+    read_queue.put(None)
 
 def capture_env_var(line, env, printer, prompt):
-    '''A bit of exe_run that needs to be called from two places'''
+    '''Capture a KEY=VALUE line output by "set" in exe_run'''
     # Find a KEY=VALUE bit in the line,
     # parse it out and put it in the dictionary
     # we were given
-    pair = line.split('=', 1)
-    if len(pair) == 2:
-        env[pair[0]] = pair[1].rstrip()
+    key, separator, value = line.partition('=')
+    if separator:
+        env[key] = value.rstrip()
     else:
         printer.string("{}WARNING: not an environment variable: \"{}\"".
                        format(prompt, line))
@@ -473,7 +588,9 @@ def exe_run(call_list, guard_time_seconds, printer, prompt,
     success = False
     start_time = time()
     flibbling = False
+    looking_for_flibble = returned_env is not None
     kill_time = None
+    process = None
     read_time = start_time
 
     if returned_env is not None:
@@ -485,7 +602,7 @@ def exe_run(call_list, guard_time_seconds, printer, prompt,
         # from which we can parse the environment
         call_list.append("&&")
         call_list.append("echo")
-        call_list.append("flibble")
+        call_list.append(FLIBBLE)
         call_list.append("&&")
         call_list.append("set")
         # I've seen output from set get lost,
@@ -502,11 +619,24 @@ def exe_run(call_list, guard_time_seconds, printer, prompt,
         # that is ignored 'cos the output is considered
         # binary.  Seems to work in any case, I guess
         # Winders, at least, is in any case line-buffered.
+        # On Linux the process is started in a session of
+        # its own so that exe_terminate() can kill the lot
         process = subprocess.Popen(call_list,
                                    stdout=subprocess.PIPE,
                                    stderr=subprocess.STDOUT,
                                    shell=shell_cmd,
-                                   env=set_env)
+                                   env=set_env,
+                                   start_new_session=IS_LINUX)
+        if IS_LINUX:
+            try:
+                # F_SETPIPE_SZ, 1031, isn't in fcntl before Python 3.10
+                fcntl.fcntl(process.stdout.fileno(),
+                            getattr(fcntl, "F_SETPIPE_SZ", 1031),
+                            EXE_RUN_PIPE_SIZE)
+            except OSError:
+                # Not allowed more than /proc/sys/fs/pipe-max-size,
+                # just go with what we have
+                pass
         printer.string("{}{}, pid {} started with guard time {} second(s)". \
                        format(prompt, call_list[0], process.pid,
                               guard_time_seconds))
@@ -516,16 +646,18 @@ def exe_run(call_list, guard_time_seconds, printer, prompt,
         # it also doesn't flush and close stdout and so read(1)
         # will hang, meaning we can't read its output as a means
         # to check that it has hung.
-        # So, here we poll for the return value, which is normally
-        # how things will end, and we start another thread which
-        # reads from the process's stdout.  If the thread sees
-        # nothing for guard_time_seconds then we terminate the
-        # process.
+        # So, here we start another thread which reads lines from
+        # the process's stdout onto a queue, ending with None at
+        # EOF, and we block on that queue.  If nothing is seen
+        # for guard_time_seconds then we terminate the process.
+        # Note: selectors would avoid the thread but they
+        # don't work on pipes under Windows.
         read_queue = queue.Queue()
         read_thread = threading.Thread(target=read_from_process_and_queue,
-                                       args=(process, read_queue))
+                                       args=(process, read_queue),
+                                       daemon=True)
         read_thread.start()
-        while process.poll() is None:
+        while True:
             if guard_time_seconds and (kill_time is None) and   \
                ((time() - start_time > guard_time_seconds) or
                 (time() - read_time > guard_time_seconds)):
@@ -534,53 +666,39 @@ def exe_run(call_list, guard_time_seconds, printer, prompt,
                                " expired, stopping {}...".
                                format(prompt, guard_time_seconds,
                                       call_list[0]))
-                exe_terminate(process.pid)
-            line = queue_get_no_exception(read_queue, True, EXE_RUN_QUEUE_WAIT_SECONDS)
+                exe_terminate(process)
+            try:
+                line = read_queue.get(block=True,
+                                      timeout=EXE_RUN_QUEUE_WAIT_SECONDS)
+            except queue.Empty:
+                # Nothing arrived: if the process has gone but
+                # stdout was never closed (nrfjprog again) there
+                # will be no EOF so stop here
+                if process.poll() is not None:
+                    break
+                continue
+            if line is None:
+                # EOF: everything the process wrote has been read,
+                # give it a moment to exit, otherwise keep going
+                # so that the guard timer still applies
+                try:
+                    process.wait(timeout=EXE_RUN_QUEUE_WAIT_SECONDS)
+                    break
+                except subprocess.TimeoutExpired:
+                    continue
             read_time = time()
-            while line is not None:
-                line = line.rstrip()
-                if flibbling:
-                    capture_env_var(line, returned_env, printer, prompt)
-                else:
-                    if returned_env is not None and "flibble" in line:
-                        flibbling = True
-                    else:
-                        printer.string("{}{}".format(prompt, line))
-                line = queue_get_no_exception(read_queue, True, EXE_RUN_QUEUE_WAIT_SECONDS)
-                read_time = time()
-
-        # Can't join() read_thread here as it might have
-        # blocked on a read() (if nrfjprog has anything to
-        # do with it).  It will be tidied up when this process
-        # exits.
-
-        # There may still be stuff on the queue, read it out here
-        line = queue_get_no_exception(read_queue, True, EXE_RUN_QUEUE_WAIT_SECONDS)
-        while line is not None:
             line = line.rstrip()
             if flibbling:
                 capture_env_var(line, returned_env, printer, prompt)
+            elif looking_for_flibble and FLIBBLE in line:
+                flibbling = True
             else:
-                if returned_env is not None and "flibble" in line:
-                    flibbling = True
-                else:
-                    printer.string("{}{}".format(prompt, line))
-            line = queue_get_no_exception(read_queue, True, EXE_RUN_QUEUE_WAIT_SECONDS)
-
-        # There may still be stuff in the buffer after
-        # the application has finished running so flush that
-        # out here
-        line = process.stdout.readline().decode()
-        while line:
-            line = line.rstrip()
-            if flibbling:
-                capture_env_var(line, returned_env, printer, prompt)
-            else:
-                if returned_env is not None and "flibble" in line:
-                    flibbling = True
-                else:
-                    printer.string("{}{}".format(prompt, line))
-            line = process.stdout.readline().decode()
+                printer.string("{}{}".format(prompt, line))
+
+        # Can't join() read_thread here as it might have
+        # blocked on a read() (if nrfjprog has anything to
+        # do with it); it is a daemon so it will be tidied
+        # up when this process exits.
 
         if (process.poll() == 0) and kill_time is None:
             success = True
@@ -590,6 +708,14 @@ def exe_run(call_list, guard_time_seconds, printer, prompt,
     except ValueError as ex:
         printer.string("{}failed: {} while trying to execute {}.". \
                        format(prompt, type(ex).__name__, str(ex)))
+    except (KeyboardInterrupt, SystemExit):
+        # Being in its own session, the process won't have
+        # seen the CTRL-C on Linux, and the signal handlers
+        # of the u_run processes turn that into SystemExit,
+        # so take it down with us
+        if process and (process.poll() is None):
+            exe_terminate(process)
+        raise
 
     return success
 
@@ -604,14 +730,8 @@ class ExeRun():
         self._process = None
     def __enter__(self):
         if self._printer:
-            text = ""
-            for idx, item in enumerate(self._call_list):
-                if idx == 0:
-                    text = item
-                else:
-                    text += " {}".format(item)
             self._printer.string("{}starting {}...".format(self._prompt,
-                                                           text))
+                                                           " ".join(self._call_list)))
         try:
             # Start exe
             if self._with_stdin:
@@ -651,14 +771,22 @@ class ExeRun():
             while (self._process.poll() is None) and (retry > 0):
                 # Try to stop with CTRL-C
                 self._process.send_signal(signal.CTRL_BREAK_EVENT)
-                sleep(1)
+                try:
+                    # Returns as soon as the process has ended
+                    self._process.wait(timeout=1)
+                except subprocess.TimeoutExpired:
+                    pass
                 retry -= 1
             return_value = self._process.poll()
             if not return_value:
                 # Terminate with a vengeance
                 self._process.terminate()
-                while self._process.poll() is None:
-                    pass
+                try:
+                    self._process.wait(timeout=5)
+                except subprocess.TimeoutExpired:
+                    # ...and if that doesn't do it, kill it
+                    self._process.kill()
+                    self._process.wait()
                 self._printer.string("{}{} pid {} terminated".format(self._prompt,
                                                                      self._call_list[0],
                                                                      self._process.pid))
@@ -681,11 +809,20 @@ class SwoDecoder():
         self._address = address
         self._replace_lf_with_crlf = replaceLfWithCrLf
         self._expecting_swit = True
+        # The SWIT header bytes for our address: bit 2
+        # may have either value (see decode() below)
+        self._swit_bytes = frozenset([(address << 3) | 0x01,
+                                      (address << 3) | 0x05])
 
     def decode(self, swo_byte_array):
         '''Do the decode'''
         decoded_byte_array = bytearray()
         if swo_byte_array:
+            # This loop is run for every byte so keep
+            # what it needs in local variables
+            append = decoded_byte_array.append
+            swit_bytes = self._swit_bytes
+            expecting_swit = self._expecting_swit
             for data_byte in swo_byte_array:
                 # We're looking only for "address" and we also know
                 # that CMSIS only offers ITM_SendChar(), so packet length
@@ -710,37 +847,38 @@ class SwoDecoder():
                 # special circumstances so it is not a recovery
                 # mechanism for simply losing a byte in the
                 # transfer, which does happen occasionally.
-                if self._expecting_swit:
-                    if ((data_byte & 0x03) == 0x01) and ((data_byte & 0xf8) >> 3 == self._address):
+                if expecting_swit:
+                    if data_byte in swit_bytes:
                         # Trace packet type is SWIT, i.e. our
                         # application logging
-                        self._expecting_swit = False
+                        expecting_swit = False
                 else:
                     if data_byte & 0x80 == 0:
-                        if (data_byte == 10) and self._replace_lf_with_crlf:
-                            decoded_byte_array.append(13)
-                        decoded_byte_array.append(data_byte)
-                    self._expecting_swit = True
+                        append(data_byte)
+                    expecting_swit = True
+            self._expecting_swit = expecting_swit
+            if self._replace_lf_with_crlf:
+                decoded_byte_array = decoded_byte_array.replace(b"\n", b"\r\n")
         return decoded_byte_array
 
 class PrintThread(threading.Thread):
     '''Print thread to organise prints nicely'''
     def __init__(self, print_queue):
         self._queue = print_queue
-        self._running = False
         threading.Thread.__init__(self)
     def stop_thread(self):
         '''Helper function to stop the thread'''
-        self._running = False
+        # None is never printed: it tells run() to stop
+        # once everything queued before it is printed
+        self._queue.put(None)
     def run(self):
         '''Worker thread'''
-        self._running = True
-        while self._running:
-            try:
-                my_string = self._queue.get(block=False, timeout=0.5)
-                print(my_string)
-            except queue.Empty:
-                pass
+        while True:
+            # Block until there is something to print
+            my_string = self._queue.get()
+            if my_string is None:
+                break
+            print(my_string)
 
 class PrintToQueue():
     '''Print to a queue, if there is one'''
@@ -748,18 +886,47 @@ class PrintToQueue():
         self._queue = print_queue
         self._file_handle = file_handle
         self._include_timestamp = include_timestamp
+        self._file_lock = threading.Lock()
+        self._flush_timer = None
+        self._timestamp_seconds = None
+        self._timestamp = None
     def string(self, string, file_only=False):
         '''Print a string'''
         if self._include_timestamp:
-            string = strftime(TIME_FORMAT, gmtime()) + " " + string
+            # The timestamp only changes once a second
+            # so only format it once a second
+            now = int(time())
+            if now != self._timestamp_seconds:
+                self._timestamp = strftime(TIME_FORMAT, gmtime(now))
+                self._timestamp_seconds = now
+            string = self._timestamp + " " + string
         if not file_only:
             if self._queue:
                 self._queue.put(string)
             else:
                 print(string)
         if self._file_handle:
-            self._file_handle.write(string + "\n")
-            self._file_handle.flush()
+            # Leave the file's buffer to gather lines up and
+            # have a timer flush it PRINT_FILE_FLUSH_SECONDS
+            # after the first of them, so that nothing sits
+            # there through a quiet period (or is lost if
+            # this process is terminated)
+            with self._file_lock:
+                self._file_handle.write(string + "\n")
+                if not self._flush_timer:
+                    self._flush_timer = threading.Timer(PRINT_FILE_FLUSH_SECONDS,
+                                                        self._flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+    def _flush(self):
+        '''Flush the file: called by the timer'''
+        with self._file_lock:
+            self._flush_timer = None
+            try:
+                self._file_handle.flush()
+            except ValueError:
+                # The file has been closed, which flushes it
+                pass
 
 # This stolen from here:
 # https://stackoverflow.com/questions/431684/how-do-i-change-the-working-directory-in-python
@@ -791,31 +958,26 @@ class Lock():
             return True
         # Wait on the lock
         if not self._locked:
-            timeout_seconds = self._guard_time_seconds
             self._printer.string("{}waiting up to {} second(s)"      \
                                  " for a {} lock...".                \
                                  format(self._prompt,
                                         self._guard_time_seconds,
                                         self._lock_type))
-            count = 0
-            while not self._lock.acquire(False) and                \
-                ((self._guard_time_seconds == 0) or (timeout_seconds > 0)):
-                sleep(1)
-                timeout_seconds -= 1
-                count += 1
-                if count == 30:
-                    self._printer.string("{}still waiting {} second(s)"     \
-                                         " for a {} lock (locker is"        \
-                                         " currently {}).".                 \
-                                         format(self._prompt, timeout_seconds,
-                                                self._lock_type, self._lock))
-                    count = 0
-            if (self._guard_time_seconds == 0) or (timeout_seconds > 0):
-                self._locked = True
+            self._locked = acquire_with_reports(self._lock,
+                                                self._guard_time_seconds,
+                                                self._report_still_waiting)
+            if self._locked:
                 self._printer.string("{}{} lock acquired ({}).".              \
                                      format(self._prompt, self._lock_type,
                                             self._lock))
         return self._locked
+    def _report_still_waiting(self, timeout_seconds):
+        '''Called by acquire_with_reports() while waiting'''
+        self._printer.string("{}still waiting {} second(s)"     \
+                             " for a {} lock (locker is"        \
+                             " currently {}).".                 \
+                             format(self._prompt, timeout_seconds,
+                                    self._lock_type, self._lock))
     def __exit__(self, _type, value, traceback):
         del _type
         del value
@@ -831,8 +993,12 @@ class Lock():
                 self._printer.string("{}{} lock was already released.". \
                                      format(self._prompt, self._lock_type))
 
+# Note: if completion_condition is given then whoever removes
+# an item from list must do so while holding it and then
+# notify_all() it, which allows us to wait on the condition
+# rather than polling the list.
 def wait_for_completion(list, purpose, guard_time_seconds,
-                        printer, prompt):
+                        printer, prompt, completion_condition=None):
     '''Wait for a completion list to empty'''
     completed = False
     if len(list) > 0:
@@ -840,13 +1006,27 @@ def wait_for_completion(list, purpose, guard_time_seconds,
         printer.string("{}waiting up to {} second(s)"      \
                        " for {} completion...".          \
                        format(prompt, guard_time_seconds, purpose))
-        count = 0
+        start_time = time()
+        report_time = start_time
         while (len(list) > 0) and                          \
           ((guard_time_seconds == 0) or (timeout_seconds > 0)):
-            sleep(1)
-            timeout_seconds -= 1
-            count += 1
-            if count == 30:
+            if completion_condition:
+                # Wait to be told that something has completed
+                # or until it is time to say we're still waiting;
+                # checking the list while holding the condition
+                # means that a removal can't be missed
+                wait_seconds = STILL_WAITING_REPORT_SECONDS - (time() - report_time)
+                if (guard_time_seconds > 0) and (timeout_seconds < wait_seconds):
+                    wait_seconds = timeout_seconds
+                with completion_condition:
+                    if (len(list) > 0) and (wait_seconds > 0):
+                        completion_condition.wait(timeout=wait_seconds)
+            else:
+                sleep(1)
+            timeout_seconds = guard_time_seconds - int(time() - start_time)
+            if (len(list) > 0) and                         \
+               ((guard_time_seconds == 0) or (timeout_seconds > 0)) and \
+               (time() - report_time >= STILL_WAITING_REPORT_SECONDS):
                 list_text = ""
                 for item in list:
                     if list_text:
@@ -857,7 +1037,7 @@ def wait_for_completion(list, purpose, guard_time_seconds,
                                " for {}).".                     \
                                format(prompt, timeout_seconds,
                                       purpose, list_text))
-                count = 0
+                report_time = time()
         if len(list) == 0:
             completed = True
             printer.string("{}{} completed.".format(prompt, purpose))
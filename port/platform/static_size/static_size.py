@@ -4,13 +4,17 @@
 
 from multiprocessing import Process, freeze_support # Needed to make Windows behave
                                                     # when run under multiprocessing,
-from signal import signal, SIGINT   # For CTRL-C handling
-from time import time
+from signal import signal, SIGINT, SIGTERM # For CTRL-C handling and exe_terminate()
+from concurrent.futures import ThreadPoolExecutor # For compiling in parallel
 import os
 import sys # For exit() and stdout
+import threading # For the exe_run() guard timer and RUNNING_PROCESSES
 import argparse
 import subprocess
-import psutil                   # For killing things (make sure to do pip install psutil)
+import shutil # For which()
+import shlex # For splitting flags
+if os.name == "nt":
+    from signal import CTRL_BREAK_EVENT # For exe_terminate(), Windows only
 
 # Expected name for compiler
 GNU_COMPILER = "arm-none-eabi-gcc"
@@ -24,149 +28,269 @@ GNU_SIZE = "arm-none-eabi-size"
 # The guard time in seconds for each compilation
 GUARD_TIME_SECONDS = 30
 
+# How long to give a process to stop before killing it
+TERMINATE_WAIT_SECONDS = 5
+
+# The most to read from the output of an executable at once
+READ_SIZE = 65536
+
+# The response file listing the object files for the
+# linker and size, written to the build directory
+OBJ_LIST_FILE = "obj_list.txt"
+
 # Sub-directory to use when building
 BUILD_SUBDIR = "build"
 
+# The processes currently being run by exe_run(), so that
+# they can be stopped if we are interrupted
+RUNNING_PROCESSES = set()
+
+# Lock for RUNNING_PROCESSES: re-entrant since the signal
+# handler, which takes it, runs on the main thread, which
+# may already be holding it
+RUNNING_PROCESSES_LOCK = threading.RLock()
+
+# Set once we are stopping, so that exe_run() starts nothing new
+STOPPING = threading.Event()
+
 def signal_handler(sig, frame):
-    '''CTRL-C Handler'''
-    del sig
+    '''CTRL-C and SIGTERM Handler'''
     del frame
     sys.stdout.write('\n')
-    print("CTRL-C received, EXITING.")
+    if sig == SIGINT:
+        print("CTRL-C received, EXITING.")
+    else:
+        print("SIGTERM received, EXITING.")
+    # What we've started is in a process group of its own,
+    # which the signal won't have reached, so stop it here
+    stop_processes()
     sys.exit(-1)
 
 def get_flags(string, name):
     '''Get CFLAGS or LDFLAGS as a list from str or the environment'''
-    answer_list = []
+    if not string:
+        string = os.environ.get(name, "")
 
-    if not string and name in os.environ:
-        string = os.environ[name]
-    if string:
-        answer_list = string.split(" ")
-
-    return answer_list
+    # Split as a shell would, so that runs of spaces don't
+    # give empty flags and quoted flags stay whole; backslashes
+    # are only escape characters off Windows
+    return shlex.split(string, posix=(os.name != "nt"))
 
 def read_list_from_file(file):
-    '''Read a list, line by line, from a file'''
+    '''Read a list, line by line, from a file, without duplicates'''
     output_list = []
+    seen = set()
 
-    # Read list
-    temp_list = [line.strip() for line in open(file, 'r')]
-    for item in temp_list:
-        # Throw away comment lines
-        item = item.strip()
-        if item and not item.startswith("#"):
-            output_list.append(item)
+    # Read list, throwing away blank and comment lines
+    # and any duplicates, keeping the order
+    with open(file, 'r') as file_handle:
+        for line in file_handle:
+            item = line.strip()
+            if item and not item.startswith("#") and item not in seen:
+                seen.add(item)
+                output_list.append(item)
 
     return output_list
 
-def exe_terminate(process_pid):
+def exe_terminate(process):
     '''Jonathan's killer'''
-    process = psutil.Process(process_pid)
-    for proc in process.children(recursive=True):
-        proc.terminate()
-    process.terminate()
+    # exe_run() starts each process in a group of its own,
+    # so the process and anything it started can be stopped
+    # in one go
+    try:
+        if os.name == "nt":
+            os.kill(process.pid, CTRL_BREAK_EVENT)
+        else:
+            os.killpg(process.pid, SIGTERM)
+    except OSError:
+        # Got there on its own in the meantime
+        pass
+
+def exe_kill(process):
+    '''Kill a process if it hasn't stopped after exe_terminate()'''
+    try:
+        process.wait(TERMINATE_WAIT_SECONDS)
+    except subprocess.TimeoutExpired:
+        # CTRL_BREAK_EVENT, in particular, can be ignored
+        process.kill()
+
+def stop_processes():
+    '''Stop everything exe_run() is running and start nothing more'''
+    with RUNNING_PROCESSES_LOCK:
+        STOPPING.set()
+        processes = list(RUNNING_PROCESSES)
+    # Ask them all first, so that the waits overlap
+    for process in processes:
+        exe_terminate(process)
+    for process in processes:
+        exe_kill(process)
+
+def guard_time_expired(process, call_list, guard_time_seconds, expired):
+    '''Called by exe_run()'s timer if the guard time runs out'''
+    expired.set()
+    print("guard time of {} second(s)." \
+          " expired, stopping {}...".
+          format(guard_time_seconds, call_list[0]))
+    exe_terminate(process)
+    exe_kill(process)
 
 def exe_run(call_list, guard_time_seconds, shell_cmd=False):
     '''Call an executable, printing out what it does'''
     success = False
-    start_time = time()
-    kill_time = None
+    expired = threading.Event()
+    timer = None
+    process = None
 
     try:
-        process = subprocess.Popen(call_list,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.STDOUT,
-                                   shell=shell_cmd)
-        while process.poll() is None:
-            string = process.stdout.readline()
-            if string:
-                print("{}".format(string.decode()), end="")
-            if guard_time_seconds and (kill_time is None) and   \
-               (time() - start_time > guard_time_seconds):
-                kill_time = time()
-                print("guard time of {} second(s)." \
-                      " expired, stopping {}...".
-                      format(guard_time_seconds, call_list[0]))
-                exe_terminate(process.pid)
-        if (process.poll() == 0) and kill_time is None:
+        # Start the process and record it under the lock, so
+        # that stop_processes() either sees it or stops it
+        # being started at all
+        with RUNNING_PROCESSES_LOCK:
+            if STOPPING.is_set():
+                return success
+            if os.name == "nt":
+                process = subprocess.Popen(call_list,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT,
+                                           shell=shell_cmd,
+                                           creationflags=subprocess.CREATE_NEW_PROCESS_GROUP)
+            else:
+                process = subprocess.Popen(call_list,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT,
+                                           shell=shell_cmd,
+                                           start_new_session=True)
+            RUNNING_PROCESSES.add(process)
+        # Rather than checking the time between reads, which
+        # would only happen when there is output, set a timer
+        # to stop the process if the guard time expires
+        if guard_time_seconds:
+            timer = threading.Timer(guard_time_seconds, guard_time_expired,
+                                    args=(process, call_list,
+                                          guard_time_seconds, expired))
+            # Don't let the timer hold up exiting
+            timer.daemon = True
+            timer.start()
+        # Read the output in chunks, as much as is there each
+        # time, until EOF, and print it in one go at the end
+        # so that the output of compilations running in
+        # parallel isn't mixed up
+        chunks = []
+        chunk = process.stdout.read1(READ_SIZE)
+        while chunk:
+            chunks.append(chunk)
+            chunk = process.stdout.read1(READ_SIZE)
+        process.stdout.close()
+        process.wait()
+        with RUNNING_PROCESSES_LOCK:
+            RUNNING_PROCESSES.discard(process)
+        if chunks:
+            print(b"".join(chunks).decode(), end="")
+        if (process.poll() == 0) and not expired.is_set():
             success = True
-    except ValueError as ex:
+    except (ValueError, OSError) as ex:
         print("failed: {} while trying to execute {}.". \
               format(type(ex).__name__, str(ex)))
+    except (KeyboardInterrupt, SystemExit):
+        # The signal may have arrived before the process
+        # was added to RUNNING_PROCESSES, where the signal
+        # handler would have found it
+        if process:
+            exe_terminate(process)
+            exe_kill(process)
+        raise
+    finally:
+        # Cancel the timer however we leave
+        if timer:
+            timer.cancel()
 
     return success
 
+def compile_source(compile_call, item):
+    '''Compile a single source file, returning True on success'''
+    if STOPPING.is_set():
+        # Don't print what we're not going to do
+        return False
+    call_list = compile_call + [item]
+    # Print what we're gonna do
+    print(" ".join(call_list))
+    return exe_run(call_list, GUARD_TIME_SECONDS)
+
 # Note: we don't bother with make here as there are few files,
 # this is usually run as part of automated testing where a
 # clean build is required anyway and make can be a but funny
 # about platform differences for if/when we want to run this
 # on Linux
-def build(source_list, include_list, cflag_list, ldflag_list, gcc_bin_dir):
+def build(source_list, include_list, cflag_list, ldflag_list, gcc_bin_dir,
+          jobs=None):
     '''Build source_list with include_list and flags under GCC'''
     return_value = 0
     obj_list = []
 
-    # Make the include list
-    for idx, item in enumerate(include_list):
-        include_list[idx] = "-I" + item
-
-    # Compile all the source files
-    for item in source_list:
-        call_list = [gcc_bin_dir + os.sep + GNU_COMPILER]
-        call_list.extend(include_list)
-        call_list.extend(cflag_list)
-        call_list.append("-c")
-        call_list.append(item)
-        # Print what we're gonna do
-        tmp = ""
-        for another_item in call_list:
-            tmp += " " + another_item
-        print("{}".format(tmp))
-        if not exe_run(call_list, GUARD_TIME_SECONDS, True):
-            return_value = -1
+    # Everything but the source file is the same for each
+    # compilation so put that together once
+    compile_call = [gcc_bin_dir + os.sep + GNU_COMPILER]
+    compile_call.extend(["-I" + item for item in include_list])
+    compile_call.extend(cflag_list)
+    compile_call.append("-c")
+
+    # Compile all the source files, in parallel: the work
+    # is done by GCC in its own process so threads will do
+    if not jobs:
+        jobs = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(compile_source, compile_call, item)
+                   for item in source_list]
+        try:
+            for future in futures:
+                if not future.result():
+                    return_value = -1
+        except (KeyboardInterrupt, SystemExit):
+            # Leaving the with block waits for the workers, so
+            # drop the compilations that haven't started and stop
+            # those that have, otherwise everything gets compiled
+            for future in futures:
+                future.cancel()
+            stop_processes()
+            raise
 
     if return_value == 0:
-        # Now link them
-        for file in source_list:
-            parts = file.split("/")
-            file = parts[len(parts) - 1]
-            file = file.replace(".cpp", ".o")
-            file = file.replace(".c", ".o")
-            obj_list.append(file)
+        # Now link them: GCC will have put the object
+        # file for each source file in the current directory
+        obj_list = [os.path.splitext(os.path.basename(file))[0] + ".o"
+                    for file in source_list]
+        # Pass the object files to the linker, and to size
+        # below, in a response file, so that however many
+        # there are the command line stays short
+        with open(OBJ_LIST_FILE, "w") as file_handle:
+            file_handle.write("\n".join(obj_list) + "\n")
         call_list = [gcc_bin_dir + os.sep + GNU_LINKER]
-        call_list.extend(obj_list)
+        call_list.append("@" + OBJ_LIST_FILE)
         # Order is important: has to be after the object
         # list or libraries (e.g. -lm) might not be resolved
         call_list.extend(ldflag_list)
         call_list.append("-o")
         call_list.append("total_with_clib.elf")
         # Print what we're gonna do
-        tmp = ""
-        for item in call_list:
-            tmp += " " + item
-        print("{}".format(tmp))
-        if not exe_run(call_list, GUARD_TIME_SECONDS, True):
+        print(" ".join(call_list))
+        if not exe_run(call_list, GUARD_TIME_SECONDS):
             return_value = -1
 
     if return_value == 0:
         # Call size on the result
         call_list = [gcc_bin_dir + os.sep + GNU_SIZE]
         call_list.append("-G")
-        call_list.extend(obj_list)
+        call_list.append("@" + OBJ_LIST_FILE)
         call_list.append("total_with_clib.elf")
         # Print what we're gonna do
-        tmp = ""
-        for item in call_list:
-            tmp += " " + item
-        print("{}".format(tmp))
-        if not exe_run(call_list, GUARD_TIME_SECONDS, True):
+        print(" ".join(call_list))
+        if not exe_run(call_list, GUARD_TIME_SECONDS):
             return_value = -1
 
     return return_value
 
 def main(source_files, include_paths, cflags, ldflags, gcc_bin_dir,
-         ubxlib_dir, working_dir):
+         ubxlib_dir, working_dir, jobs=None):
     '''Main as a function'''
     return_value = 1
     saved_path = None
@@ -175,6 +299,7 @@ def main(source_files, include_paths, cflags, ldflags, gcc_bin_dir,
     test_call = []
 
     signal(SIGINT, signal_handler)
+    signal(SIGTERM, signal_handler)
 
     # Print out what we've been told to do
     text = "compiling list of files from \"" + source_files + "\"" \
@@ -203,10 +328,8 @@ def main(source_files, include_paths, cflags, ldflags, gcc_bin_dir,
 
     if ubxlib_dir:
         # Prepend ubxlib to them
-        for idx, item in enumerate(source_list):
-            source_list[idx] = ubxlib_dir + os.sep + item
-        for idx, item in enumerate(include_list):
-            include_list[idx] = ubxlib_dir + os.sep + item
+        source_list = [ubxlib_dir + os.sep + item for item in source_list]
+        include_list = [ubxlib_dir + os.sep + item for item in include_list]
 
     cflag_list = get_flags(cflags, "CFLAGS")
     ldflag_list = get_flags(ldflags, "LDFLAGS")
@@ -219,15 +342,21 @@ def main(source_files, include_paths, cflags, ldflags, gcc_bin_dir,
             os.mkdir(BUILD_SUBDIR)
         os.chdir(BUILD_SUBDIR)
 
-    # Check that the compiler can be found
+    # Check that the compiler can be found, looking on the
+    # PATH if we've not been given a directory, and from then
+    # on use the directory it was found in
     print("checking that GCC is installed...")
-    if gcc_bin_dir:
-        test_call.append(gcc_bin_dir + os.sep + GNU_COMPILER)
-    test_call.append("--version")
-    if exe_run(test_call, GUARD_TIME_SECONDS, True):
+    gcc_path = shutil.which(GNU_COMPILER, path=gcc_bin_dir)
+    if gcc_path:
+        gcc_bin_dir = os.path.dirname(gcc_path)
+        # Still run it to get the version into the log: the
+        # sizes depend on it
+        test_call.append(gcc_path)
+        test_call.append("--version")
+    if gcc_path and exe_run(test_call, GUARD_TIME_SECONDS):
         # Do the build
         return_value = build(source_list, include_list, cflag_list,
-                             ldflag_list, gcc_bin_dir)
+                             ldflag_list, gcc_bin_dir, jobs)
     else:
         print("unable to run GCC.\n")
 
@@ -267,6 +396,9 @@ if __name__ == "__main__":
                         " -mfloat-abi=hard -mfpu=fpv4-sp-d16"      \
                         " --specs=nano.specs -lc -lnosys -lm\".")
     PARSER.add_argument("-u", help="the root directory of ubxlib.")
+    PARSER.add_argument("-j", type=int, help="the number of files to"\
+                        " compile at once; if none is given the"    \
+                        " number of CPUs is used.")
     PARSER.add_argument("-w", help="an empty working directory to" \
                         " use; if none is given \"" + BUILD_SUBDIR + \
                         "\" will be created and used.")
@@ -281,7 +413,7 @@ if __name__ == "__main__":
 
     # Call main()
     RETURN_VALUE = main(ARGS.source, ARGS.include, ARGS.c, ARGS.l,
-                        ARGS.p, ARGS.u, ARGS.w)
+                        ARGS.p, ARGS.u, ARGS.w, ARGS.j)
 
     sys.exit(RETURN_VALUE)
 